@@ -10,28 +10,23 @@ import os
 import sys
 import csv
 import time
-import glob
-import socket
 import logging
 import random
 import numpy as np
 import pandas as pd
-from google.cloud import bigquery
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-import torchvision
-import torchvision.transforms as transforms
 from torch.utils.data import Dataset, DataLoader
-import plotly
 import matplotlib.pyplot as plt
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split, KFold, StratifiedKFold, GridSearchCV
 from sklearn.feature_selection import RFE, VarianceThreshold
 from sklearn.metrics import average_precision_score, roc_auc_score, roc_curve, accuracy_score, confusion_matrix
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 
 def load_excel_data(path, sheet=0):
@@ -40,37 +35,82 @@ def load_excel_data(path, sheet=0):
         logging.info(f'Loading {filename}, Sheet: {sheet}...')
     else:
         logging.info('Loading ' + filename + '...')
-    df_data = pd.read_excel(path, sheet)
+
+    # parsing xlsx is slow, so keep a parquet copy of each sheet next to the workbook
+    cache_path = f"{os.path.splitext(path)[0]}_{sheet}.parquet"
+    df_data = None
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        try:
+            df_data = pd.read_parquet(cache_path)
+        except (ImportError, OSError, ValueError) as e:
+            logging.warning(f'Could not read the parquet cache of {filename}: {e}')
+    if df_data is None:
+        df_data = pd.read_excel(path, sheet)
+        # free-text columns (e.g. Notes) mix numbers and strings, which pyarrow cannot store, so make them all
+        # strings (missing values kept). Applied to the returned frame too, so cached and uncached runs agree.
+        text_columns = df_data.select_dtypes(include='object').columns
+        df_data[text_columns] = df_data[text_columns].astype(str).where(df_data[text_columns].notna())
+        # written to a temporary file first so an interrupted run never leaves a truncated cache behind
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            df_data.to_parquet(tmp_path)
+            os.replace(tmp_path, cache_path)
+        except (ImportError, OSError, TypeError, ValueError) as e:
+            # parquet engine missing, a column pyarrow cannot type or an unwritable data directory,
+            # keep working from the xlsx
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            logging.warning(f'Could not cache {filename} as parquet, it will be parsed again next run: {e}')
     logging.info("Done loading.")
     return df_data
 
 
-def load_image_data(path, patients, limit=False):
+def load_patient_images(patient_path):
+    np_filenames = []
+    with os.scandir(patient_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                with os.scandir(entry.path) as files:
+                    np_filenames.extend(f.path for f in files if f.name.endswith('.npy'))
+    np_filenames.sort()
+    # memory-mapped, so the volumes are actually read by the multiply below, inside the loading thread
+    flair, mask = np.load(np_filenames[0], mmap_mode='r'), np.load(np_filenames[1], mmap_mode='r')
+    return np.multiply(flair, mask, dtype=np.float32)
+
+
+def find_patient_directories(path):
+    # single pass over the (network) image directory, keeping the numeric patient folders
+    with os.scandir(path) as entries:
+        return {int(entry.name): entry.path for entry in entries if entry.is_dir() and entry.name.isdigit()}
+
+
+def load_image_data(patient_paths, patients, limit=False, max_workers=8):
+    dirs = sorted(set(patients).intersection(patient_paths))
+    if limit:
+        dirs = dirs[:limit]
+
     data_images = {}
-    for root, dirs, files in os.walk(path):
-        dirs.sort(key=int)
-        dirs = list(map(int, dirs))
-        dirs = [patient for patient in dirs if patient in patients]
-        if limit:
-            dirs = dirs[:limit]
+    # loading is I/O bound, so issue the reads for several patients concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
         for d in dirs:
             logging.info(f"Loading Patient {d}...")
-            np_filenames = glob.glob(f"{os.path.join(root, f'{d}')}/*/*.npy")
-            data_images[d] = [np.load(np_filenames[0]), np.load(np_filenames[1])]
-        break
+            futures[d] = executor.submit(load_patient_images, patient_paths[d])
+        for d, future in futures.items():
+            data_images[d] = future.result()
     return data_images, dirs
 
 
-def random_seed(seed_value, use_cuda):
+def random_seed(seed_value, use_cuda, deterministic=True):
     np.random.seed(seed_value)  # set np random seed
     torch.manual_seed(seed_value)  # set torch seed
     random.seed(seed_value)  # set python random seed
     if use_cuda:
         torch.cuda.manual_seed(seed_value)
         torch.cuda.manual_seed_all(seed_value)
-        # reproducibility
-        torch.use_deterministic_algorithms(True)
-        torch.backends.cudnn.benchmark = False
+        # reproducibility, otherwise let cuDNN autotune the fastest (non-deterministic) conv kernels
+        torch.use_deterministic_algorithms(deterministic)
+        torch.backends.cudnn.benchmark = not deterministic
 
 
 ###############################################################################
@@ -172,7 +212,7 @@ class BasicBlock(nn.Module):
         if self.downsample is not None:
             residual = self.downsample(x)
 
-        out += residual
+        out.add_(residual)
         out = self.relu(out)
 
         return out
@@ -212,7 +252,7 @@ class Bottleneck(nn.Module):
         if self.downsample is not None:
             residual = self.downsample(x)
 
-        out += residual
+        out.add_(residual)
         out = self.relu(out)
 
         return out
@@ -272,23 +312,17 @@ class ResNet(nn.Module):
         self.fc = nn.Linear(block_inplanes[3] * block.expansion, n_classes)
         self.dropout = nn.Dropout(dropout_rate)
 
+        # BatchNorm3d layers are already constructed with weight 1 and bias 0, only the convolutions need re-init
         for m in self.modules():
             if isinstance(m, nn.Conv3d):
                 nn.init.kaiming_normal_(m.weight,
                                         mode='fan_out',
                                         nonlinearity='relu')
-            elif isinstance(m, nn.BatchNorm3d):
-                nn.init.constant_(m.weight, 1)
-                nn.init.constant_(m.bias, 0)
 
     def _downsample_basic_block(self, x, planes, stride):
         out = F.avg_pool3d(x, kernel_size=1, stride=stride)
-        zero_pads = torch.zeros(out.size(0), planes - out.size(1), out.size(2),
-                                out.size(3), out.size(4))
-        if isinstance(out.data, torch.cuda.FloatTensor):
-            zero_pads = zero_pads.cuda()
-
-        out = torch.cat([out.data, zero_pads], dim=1)
+        # zero-pad the channel dimension (pairs run from the last dimension backwards: W, H, D, C)
+        out = F.pad(out, (0, 0, 0, 0, 0, 0, 0, planes - out.size(1)))
 
         return out
 
@@ -317,7 +351,6 @@ class ResNet(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
-        x = self.dropout(x)
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -325,19 +358,15 @@ class ResNet(nn.Module):
             x = self.maxpool(x)
 
         x = self.layer1(x)
-        x = self.dropout(x)
         x = self.layer2(x)
-        x = self.dropout(x)
         x = self.layer3(x)
-        x = self.dropout(x)
         x = self.layer4(x)
-        x = self.dropout(x)
 
         x = self.avgpool(x)
 
         x = x.view(x.size(0), -1)
+        x = self.dropout(x)
         x = self.fc(x)
-        x = torch.sigmoid(x)
 
         return x
 
@@ -394,7 +423,7 @@ def evaluate(net, loader, criterion):
          loss: A scalar for the average loss function over the validation set
      """
     net.eval()
-    with torch.set_grad_enabled(False):
+    with torch.inference_mode():
         total_err = 0.0
         total_loss = 0.0
         total_epoch = 0
@@ -403,18 +432,22 @@ def evaluate(net, loader, criterion):
         n = 0
         for inputs, labels in loader:
             # Transfer to GPU
-            inputs, labels = inputs.to(device), labels.to(device)
-            outputs = net(inputs)
-            loss = criterion(outputs, labels.float())
-            total_loss += loss.item()
+            inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+            inputs = inputs.to(memory_format=torch.channels_last_3d)
+            with torch.autocast(device_type=device, dtype=amp_dtype, enabled=use_amp):
+                outputs = net(inputs)
+                loss = criterion(outputs, labels.float())
+            total_loss += loss.detach()
             corr = (outputs > 0.0).squeeze().long() != labels
-            total_err += int(corr.sum())
+            total_err += corr.sum()
             total_epoch += len(labels)
             n = n + 1
-            for i in range(len(labels.tolist())):
-                true.append(labels.tolist()[i][0])
-                estimated.append(outputs.tolist()[i][0])
+            # kept on the device (outputs copied, as compiled graphs reuse their buffers) until the end
+            true.append(labels.ravel())
+            estimated.append(outputs.detach().ravel().to(torch.float32, copy=True))
 
+        true = torch.cat(true).cpu().numpy()
+        estimated = torch.cat(estimated).cpu().numpy()
         auc = roc_auc_score(true, estimated)
         fpr, tpr, _ = roc_curve(true, estimated)
         total_roc = (fpr, tpr)
@@ -435,6 +468,12 @@ def train_net(trial, net, optimizer, criterion, batch_size=64, learning_rate=0.0
     total_train_roc = []
     total_val_roc = []
 
+    # loss scaling is only needed for fp16, bf16 has the same exponent range as fp32
+    scaler = torch.amp.GradScaler("cuda", enabled=use_amp and amp_dtype == torch.float16)
+
+    # noise buffer for the input augmentation, sized from the first batch and refilled in place afterwards
+    noise = None
+
     training_start_time = time.time()
 
     for epoch in range(num_epochs):
@@ -449,32 +488,39 @@ def train_net(trial, net, optimizer, criterion, batch_size=64, learning_rate=0.0
         training_estimated = []
         n = 0
         for inputs, labels in train_dataloader:
-            inputs, labels = inputs.to(device), labels.to(device)
+            inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+            inputs = inputs.to(memory_format=torch.channels_last_3d)
 
             # Add noise to images
-            noise = torch.randn_like(inputs, device=device) * 0.1
-            inputs = inputs + noise
+            if noise is None:
+                # the first batch is always a full one, so later (possibly shorter) batches fit in a slice
+                noise = torch.empty_like(inputs, memory_format=torch.channels_last_3d)
+            batch_noise = noise[:inputs.size(0)]
+            batch_noise.normal_(mean=0.0, std=0.1)
+            inputs.add_(batch_noise)
 
             # Forward + Backward + Optimize
             optimizer.zero_grad()
-            outputs = net(inputs)
-            loss = criterion(outputs, labels.float())
-            loss.backward()
-            optimizer.step()
-
-            if use_scheduler:
-                scheduler.step()
+            with torch.autocast(device_type=device, dtype=amp_dtype, enabled=use_amp):
+                outputs = net(inputs)
+                loss = criterion(outputs, labels.float())
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             corr = (outputs > 0.0).squeeze().long() != labels
             # train_err += int(corr.sum())
             # Keep track of loss through the entire epoch
-            train_loss += loss.item()
+            train_loss += loss.detach()
             total_epoch += len(labels)
             n = n + 1
 
-            for i in range(len(labels.tolist())):
-                training_true.append(labels.tolist()[i][0])
-                training_estimated.append(outputs.tolist()[i][0])
+            training_true.append(labels.ravel())
+            training_estimated.append(outputs.detach().ravel().to(torch.float32, copy=True))
+
+        # StepLR is configured in epochs
+        if use_scheduler:
+            scheduler.step()
 
         # Calculate average over epoch
         # total_train_err[epoch] = float(train_err) / total_epoch
@@ -482,7 +528,7 @@ def train_net(trial, net, optimizer, criterion, batch_size=64, learning_rate=0.0
 
         # Validation
         net.eval()
-        with torch.set_grad_enabled(False):
+        with torch.inference_mode():
             # val_err = 0.0
             val_loss = 0.0
             total_epoch = 0
@@ -490,21 +536,28 @@ def train_net(trial, net, optimizer, criterion, batch_size=64, learning_rate=0.0
             validation_estimated = []
             n = 0
             for inputs, labels in validation_dataloader:
-                inputs, labels = inputs.to(device), labels.to(device)
-                outputs = net(inputs)
-                loss = criterion(outputs, labels.float())
-                val_loss += loss.item()
+                inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+                inputs = inputs.to(memory_format=torch.channels_last_3d)
+                with torch.autocast(device_type=device, dtype=amp_dtype, enabled=use_amp):
+                    outputs = net(inputs)
+                    loss = criterion(outputs, labels.float())
+                val_loss += loss.detach()
                 corr = (outputs > 0.0).squeeze().long() != labels
                 # val_err += int(corr.sum())
                 total_epoch += len(labels)
                 n = n + 1
-                for i in range(len(labels.tolist())):
-                    validation_true.append(labels.tolist()[i][0])
-                    validation_estimated.append(outputs.tolist()[i][0])
+                validation_true.append(labels.ravel())
+                validation_estimated.append(outputs.detach().ravel().to(torch.float32, copy=True))
 
             # total_val_err[epoch] = float(val_err) / total_epoch
             total_val_loss[epoch] = float(val_loss) / (n + 1)
 
+        # Move labels and predictions to the host once per epoch
+        training_true = torch.cat(training_true).cpu().numpy()
+        training_estimated = torch.cat(training_estimated).cpu().numpy()
+        validation_true = torch.cat(validation_true).cpu().numpy()
+        validation_estimated = torch.cat(validation_estimated).cpu().numpy()
+
         # Calculate the AUC for the different models
         train_auc = roc_auc_score(training_true, training_estimated)
         val_auc = roc_auc_score(validation_true, validation_estimated)
@@ -568,23 +621,10 @@ def train_net(trial, net, optimizer, criterion, batch_size=64, learning_rate=0.0
 
 ########################################################################
 # Other functions
-def create_label(mutation, fusion):
-    if mutation == 1:
-        return 1
-    elif fusion == 1:
-        return 0
-    else:
-        return None
-
-
 def process_excel(df_data, exclusions):
-    nanmask = np.isnan(df_data["code"])
-    data_data_new = df_data[~nanmask]
-    data_data_new = data_data_new.reindex()
-
-    # Remove exluded patients
-    data_data_new = data_data_new[~data_data_new["code"].isin(exclusions)]
-    data_data_new = data_data_new.reindex()
+    # Remove non-patient entries and exluded patients
+    code = df_data["code"].to_numpy()
+    data_data_new = df_data.loc[~np.isnan(code) & ~np.isin(code, exclusions)]
 
     # Remove data that we don't need for this analysis
     data_data_new = data_data_new.drop(columns=['WT', 'NF1',
@@ -593,25 +633,21 @@ def process_excel(df_data, exclusions):
                                                 'Further gen info', 'Notes', 'Pathology Dx_Original', 'Pathology Coded',
                                                 'Location_1', 'Location_2', 'Location_Original', 'Gender', 'Age Dx'])
 
-    data_data_new['label'] = data_data_new.apply(lambda x: create_label(x['BRAF V600E final'], x['BRAF fusion final']),
-                                                 axis=1)
+    # BRAF mutation -> 1, BRAF fusion -> 0, anything else -> NaN
+    mutation = data_data_new['BRAF V600E final'].to_numpy()
+    fusion = data_data_new['BRAF fusion final'].to_numpy()
+    data_data_new['label'] = np.where(mutation == 1, 1.0, np.where(fusion == 1, 0.0, np.nan))
     data_data_new = data_data_new.drop(columns=["BRAF V600E final", "BRAF fusion final"])
 
     # Drop rows where the outcome is not mutation or fusion
     nanmask = np.isnan(data_data_new["label"])
     data_data_new = data_data_new[~nanmask]
-    data_data_new = data_data_new.reindex()
-    patient_codes = [int(x) for x in list(data_data_new["code"].values)]
 
-    training_labels = dict(zip(patient_codes, list(data_data_new["label"].values)))
-    data_data_new = data_data_new.drop(columns=["label"])
-
-    # Organize the radiomic features into a dictionary with patient codes and corresponding patient features
-    data_data_new.set_index("code", inplace=True)
-    radiomic_features = {}
-    for index, row in data_data_new.iterrows():
-        radiomic_features[index] = row.values
-    return radiomic_features, training_labels
+    # Organize the radiomic features into a (patients x features) matrix, row-aligned with labels and patient codes
+    patient_codes = data_data_new["code"].to_numpy().astype(int)
+    training_labels = data_data_new["label"].to_numpy(dtype=np.float32)
+    radiomic_features = data_data_new.drop(columns=["code", "label"]).to_numpy(dtype=np.float32)
+    return radiomic_features, training_labels, patient_codes
 
 
 ########################################################################
@@ -637,12 +673,15 @@ if __name__ == '__main__':
 
     # Parameters
     load_model = False
+    deterministic = False  # deterministic kernels for exact reproducibility, cuDNN autotuning otherwise
+    compile_model = sys.platform != 'win32'  # torch.compile the network (CUDA only, no inductor/Triton on Windows)
     use_scheduler = False
     limit = False
 
     num_trials = 10
     num_epochs = 15
     batch_size = 8
+    num_workers = 4
     learning_rate = 0.01
     dropout_rate = 0.5  # default
     inplanes = [64, 128, 256, 512]
@@ -663,33 +702,36 @@ if __name__ == '__main__':
     else:
         device = "cpu"
 
+    # mixed precision (bf16 on Ampere and newer, fp16 for older GPUs without native bf16 support)
+    use_amp = device == "cuda"
+    amp_dtype = torch.bfloat16 if use_amp and torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+    # allow TF32 for the remaining fp32 matmuls (fc layer)
+    torch.set_float32_matmul_precision('high')
+
     # Load data
     df_sickkids = load_excel_data(os.path.join(radiomics_directory, 'Nomogram_study_LGG_data_Nov.27.xlsx'), sheet='SK')
-    sickkids_radiomics_features, sickkids_labels = process_excel(df_data=df_sickkids, exclusions=excluded_patients)
+    sickkids_radiomics_features, sickkids_y, sickkids_codes = process_excel(df_data=df_sickkids,
+                                                                           exclusions=excluded_patients)
+    sickkids_labels = dict(zip(sickkids_codes.tolist(), sickkids_y.tolist()))
 
     # Prepare CNN data
     radiomics_patients_list = set(sickkids_labels.keys())
-    patients_with_FLAIR = []
-    for each_patient in os.listdir(image_directory):
-        try:
-            patients_with_FLAIR.append(int(each_patient))
-        except:
-            logging.info(f'Patient {each_patient} FLAIR not found.')
-    patients_with_FLAIR.sort(key=int)
+    patients_with_FLAIR = find_patient_directories(image_directory)
     patients_list = list(radiomics_patients_list.intersection(patients_with_FLAIR))
     logging.info(f"Total number of patients: {len(patients_list)}.")
     logging.info(f"Start-up time: {round(time.time() - start_up_time, 3)} seconds.\n")
 
     load_image_time = time.time()
-    images, patients_used = load_image_data(image_directory, patients=patients_list, limit=limit)
+    images, patients_used = load_image_data(patients_with_FLAIR, patients=patients_list, limit=limit)
+    # The FLAIR volumes come back already masked, so the datasets serve ready-made float32 tensors. The tensors are
+    # moved to shared memory so DataLoader workers map them instead of each holding a copy of every volume.
     data = {}
     for each_patient in patients_used:
-        input = torch.tensor(np.multiply(images[each_patient][0], images[each_patient][1])).float().unsqueeze(0)
-        label = sickkids_labels[each_patient]
-        label = torch.tensor(label).float().unsqueeze(0)
+        input = torch.from_numpy(images.pop(each_patient)).unsqueeze(0)
+        label = torch.tensor([sickkids_labels[each_patient]], dtype=torch.float32)
         patient = {
-            "input": input,
-            "label": label
+            "input": input.share_memory_(),
+            "label": label.share_memory_()
         }
         data[each_patient] = patient
 
@@ -715,28 +757,33 @@ if __name__ == '__main__':
     best_epochs = []
     trial_times = []
 
+    # persistent_workers and prefetch_factor are only valid with worker processes (num_workers > 0)
+    loader_kwargs = dict(batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True,
+                         persistent_workers=num_workers > 0, prefetch_factor=2 if num_workers > 0 else None)
+
+    # The dataset and split sizes are the same for every trial, only the split itself is reshuffled
+    dataset = CNNDataset(data, patients_used)
+    train_size = int(0.6 * len(dataset))
+    validation_size = int(0.2 * len(dataset))
+    test_size = len(dataset) - train_size - validation_size
+
     for t in range(num_trials):
         logging.info(f"Beginning trial {t + 1} of {num_trials}...")
         begin_trial_time = time.time()
 
         # Set the seed for this iteration
-        if t == 0:
-            random_seed(1, True)
-            next_seed = random.randint(0, 1000)
-        else:
-            random_seed(next_seed, True)
-            next_seed = random.randint(0, 1000)
+        seed = 1 if t == 0 else next_seed
+        random_seed(seed, True, deterministic=deterministic)
+        next_seed = random.randint(0, 1000)
 
-        dataset = CNNDataset(data, patients_used)
-        train_size = int(0.6 * len(dataset))
-        validation_size = int(0.2 * len(dataset))
-        test_size = len(dataset) - train_size - validation_size
+        generator = torch.Generator().manual_seed(seed)
         train_dataset, validation_dataset, test_dataset = torch.utils.data.random_split(dataset, [train_size,
                                                                                                   validation_size,
-                                                                                                  test_size])
-        train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
-        validation_dataloader = DataLoader(validation_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
-        test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+                                                                                                  test_size],
+                                                                                        generator=generator)
+        train_dataloader = DataLoader(train_dataset, **loader_kwargs)
+        validation_dataloader = DataLoader(validation_dataset, **loader_kwargs)
+        test_dataloader = DataLoader(test_dataset, **loader_kwargs)
         logging.info(f"Datasplit -> Training: {train_size}, Validation: {validation_size}, Testing: {test_size}.")
 
         net = generate_model(model_depth=18, inplanes=inplanes, n_classes=1039)
@@ -745,6 +792,10 @@ if __name__ == '__main__':
         net.fc = net.fc = nn.Linear(512, 1)
 
         net.to(device)
+        net = net.to(memory_format=torch.channels_last_3d)
+        if compile_model and device == "cuda":
+            # compiled in place so net.name and the state_dict keys of saved checkpoints are unchanged
+            net.compile(mode="reduce-overhead")
 
         criterion = nn.BCEWithLogitsLoss()
         optimizer = optim.Adam(net.parameters(), lr=learning_rate)